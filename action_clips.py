@@ -1,86 +1,169 @@
+import glob
+import math
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from numba import njit, prange
+from scipy.signal import find_peaks, peak_widths
 from tqdm import tqdm
 from moviepy.editor import VideoFileClip
+from utils import save_video_clip_from_file, smooth
 
 DELTA = 0.01  # length of subclips to sample over (in seconds)
 TRIGGER_PERCENTILE = 97
 CLIP_DIRECTORY = "action_clips"
 MIN_CLIP_DURATION = 0.25  # minimum length of action clip
+# max samples an event spans past its peak
+MAX_WALK = int(MIN_CLIP_DURATION * 20 / DELTA)
+SMOOTHING_WINDOW = 5  # samples to average over before finding events (0.05 seconds)
+AUDIO_FPS = 22000  # audio sample rate; DELTA * AUDIO_FPS must be a whole number
+
+
+def save_audio_cache(cache_path, sound_arr):
+    """
+    Writes the decoded audio to `cache_path` through a temporary file, so an interrupted
+    run never leaves a truncated cache behind. Caching is best effort: if the file can't
+    be written (e.g. the video's directory is read-only), the run continues without it
+    """
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(cache_path) or ".", suffix=".tmp"
+        )
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, sound_arr)
+        # mkstemp creates the file owner-only; give it the usual permissions for new files
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
 
-def get_clip_sample(clip, time_idx):
+def get_audio_array(clip, raw_filepath=None):
     """
-    This method takes the original clip,
-    grabs the subclip of length DELTA (in seconds) starting at time `time_idx` (seconds from start),
-    and returns an array representing the loudness of that subclip.
+    Decodes the clip's audio track once at AUDIO_FPS and returns it as a 1D float32 array
 
-    The array can be 2D if the audio is stereo (vs mono).
-    The length of the array is determined by DELTA and the FPS rate of to_soundarray()
+    Stereo audio is averaged down to mono
+    If `raw_filepath` is given, the decoded audio is cached next to the video as a .npy file
+    and memory-mapped on later runs. The cache name records the video's size and mtime,
+    so any change to the video (including replacing it with an older file) misses the cache
     """
-    return clip.audio.subclip(time_idx, time_idx + DELTA).to_soundarray(fps=44100)
+    cache_path = None
+    if raw_filepath is not None:
+        stat = os.stat(raw_filepath)
+        cache_prefix = f"{raw_filepath}.{AUDIO_FPS}."
+        cache_path = f"{cache_prefix}{stat.st_size}-{stat.st_mtime_ns}.f32.npy"
+        try:
+            return np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass  # no usable cache for this version of the video
+    sound_arr = clip.audio.to_soundarray(fps=AUDIO_FPS).astype(np.float32)
+    if sound_arr.ndim == 2:
+        sound_arr = sound_arr.mean(axis=1)
+    if cache_path is not None:
+        # drop caches left over from earlier versions of the video
+        for stale_path in glob.glob(glob.escape(cache_prefix) + "*.f32.npy"):
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+        save_audio_cache(cache_path, sound_arr)
+    return sound_arr
 
 
-def get_average_volume(sound_arr):
+@njit(parallel=True, fastmath=True, cache=True)
+def window_rms(audio, window, out):
     """
-    Returns the average volume of the audio clip given by the loudness array
-
-    The array can be 1D or 2D without issue
+    Fills `out` with the RMS volume of each consecutive `window`-sample chunk of `audio`
+    in a single pass over the array
     """
-    return np.sqrt(((1.0 * sound_arr) ** 2).mean())
+    for i in prange(out.size):
+        total = 0.0
+        base = i * window
+        for j in range(window):
+            sample = audio[base + j]
+            total += sample * sample
+        out[i] = math.sqrt(total / window)
 
 
-def get_sample_volume(clip, time_idx):
+def get_window_size(fps=AUDIO_FPS):
     """
-    Grabs the average volume of the subclip of length DELTA starting at time `time_idx`
+    Returns the number of audio samples (sampled at `fps`) in a window of length DELTA
+
+    Event times are computed as index * DELTA, so a fractional window would make them drift;
+    raises ValueError if DELTA * fps isn't a whole number
     """
-    sample = get_clip_sample(clip, time_idx)
-    return get_average_volume(sample)
+    window = round(DELTA * fps)
+    if not math.isclose(window, DELTA * fps):
+        raise ValueError(
+            f"DELTA * fps must be a whole number of samples (got {DELTA * fps:g})"
+        )
+    return window
 
 
-def get_volume_array(clip):
+def get_volume_buffer(audio, fps=AUDIO_FPS):
     """
-    Takes as many samples of length DELTA across the duration of the clip
-    and returns an array of those samples' average volumes
+    Returns `(window, volumes)`: the number of samples in a DELTA window of the audio array
+    (sampled at `fps`) and an empty float32 array with one slot per complete window
     """
-    return [
-        get_sample_volume(clip, idx) for idx in np.arange(0, clip.audio.duration, DELTA)
-    ]
+    window = get_window_size(fps)
+    return window, np.empty(len(audio) // window, dtype=np.float32)
+
+
+def get_volume_array(audio, fps=AUDIO_FPS):
+    """
+    Splits the mono audio array (sampled at `fps`) into consecutive windows of length DELTA
+    and returns an array of those windows' average (RMS) volumes
+    """
+    window, volumes = get_volume_buffer(audio, fps)
+    window_rms(np.ascontiguousarray(audio), window, volumes)
+    return volumes
 
 
 def get_action_peaks(volume_arr):
     """
-    Return indices where volume is above the 'TRIGGER_PERCENTILE'th percentile
+    Return indices of local volume peaks above the 'TRIGGER_PERCENTILE'th percentile,
+    keeping peaks at least MIN_CLIP_DURATION apart
     """
+    volume_arr = np.asarray(volume_arr)
     top_perc = np.percentile(volume_arr, TRIGGER_PERCENTILE)
-    top_indices = [idx for idx, vol in enumerate(volume_arr) if vol >= top_perc]
-    return top_indices
+    peaks, _ = find_peaks(
+        volume_arr, height=top_perc, distance=max(int(MIN_CLIP_DURATION / DELTA), 1)
+    )
+    return peaks
 
 
 def get_action_intervals(volume_arr):
     """
     Return intervals (in index) of action events
-    We define an event as any continuous stretch of time around the action peak
-    where the volume remains above the median volume
-    """
-    top_indices = get_action_peaks(volume_arr)
-    median = np.percentile(volume_arr, 50)
-
+    We define an event as the stretch of time around the action peak
+    where the volume remains above half of the peak's prominence
+    """
+    volume_arr = smooth(np.asarray(volume_arr), SMOOTHING_WINDOW)
+    peaks = get_action_peaks(volume_arr)
+    # only search MAX_WALK samples either side of each peak for its bounds
+    _, _, left_ips, right_ips = peak_widths(
+        volume_arr, peaks, rel_height=0.5, wlen=2 * MAX_WALK + 1
+    )
+    starts = np.floor(left_ips).astype(int).tolist()
+    ends = np.ceil(right_ips).astype(int).tolist()
+
+    # several peaks can belong to the same event, so merge overlapping or nested slices
     event_slices = []
-    for top_idx in top_indices:
-        # check if already in a slice
-        for start_idx, end_idx in event_slices:
-            if top_idx >= start_idx and top_idx <= end_idx:
-                break
+    for start_idx, end_idx in sorted(zip(starts, ends)):
+        if event_slices and start_idx <= event_slices[-1][1]:
+            prev_start, prev_end = event_slices[-1]
+            event_slices[-1] = (prev_start, max(prev_end, end_idx))
         else:
-            # populate new slice
-            left_idx = top_idx - 1
-            while volume_arr[left_idx] > median:
-                left_idx -= 1
-            right_idx = top_idx + 1
-            while volume_arr[right_idx] > median:
-                right_idx += 1
-            event_slices.append((left_idx, right_idx))
+            event_slices.append((start_idx, end_idx))
     return event_slices
 
 
@@ -99,36 +182,39 @@ def get_action_events(volume_arr):
     ]
 
 
-def save_video_clip(video, save_filename, t_start, t_end):
-    """
-    Takes start and end times (in seconds) for video and returns clipped
-    video and saves it locally
-    Times can be expressed in seconds (15.35), in (min, sec), in (hour, min, sec), or as a string: ‘01:03:05.35’
-    """
-    clip = video.subclip(t_start, t_end)
-    clip.write_videofile(save_filename, codec="libx264", audio_codec="aac", logger=None)
-
-
-def generate_action_clips(raw_filepath):
+def generate_action_clips(raw_filepath, volumes=None, rotated=None):
     """
     Identify and save action clips from the video of the given filepath
-    """
-    with VideoFileClip(raw_filepath) as clip:
-        if clip.rotation == 90:
-            clip = clip.resize(clip.size[::-1])
-            clip.rotation = 0
-        print("Identifying action events...")
-        volumes = get_volume_array(clip)
-        events = get_action_events(volumes)
-        print("Saving action clips...")
-        os.makedirs(CLIP_DIRECTORY, exist_ok=True)
-        with tqdm(total=len(events)) as pbar:
-            for idx, (t_start, t_end) in enumerate(events):
-                clip_number = str(idx).zfill(
-                    len(str(len(events)))
-                )  # makes a zero-padded string of the clip index (e.g. '3' -> '003')
-                pbar.set_description(f"Saving clip #{clip_number}")
-                save_video_clip(
-                    clip, f"{CLIP_DIRECTORY}/clip_{clip_number}.MOV", t_start, t_end
+    `volumes` and `rotated` can be passed in if they were already computed
+    (e.g. by `analysis.analyze`), in which case the video isn't opened for analysis
+    """
+    if volumes is None or rotated is None:
+        with VideoFileClip(raw_filepath) as clip:
+            rotated = clip.rotation == 90
+            print("Identifying action events...")
+            audio = get_audio_array(clip, raw_filepath)
+            volumes = get_volume_array(audio)
+    events = get_action_events(volumes)
+    print("Saving action clips...")
+    os.makedirs(CLIP_DIRECTORY, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for idx, (t_start, t_end) in enumerate(events):
+            clip_number = str(idx).zfill(
+                len(str(len(events)))
+            )  # makes a zero-padded string of the clip index (e.g. '3' -> '003')
+            futures.append(
+                executor.submit(
+                    save_video_clip_from_file,
+                    raw_filepath,
+                    f"{CLIP_DIRECTORY}/clip_{clip_number}.MOV",
+                    t_start,
+                    t_end,
+                    rotated,
+                    # action clips are often shorter than a keyframe interval,
+                    # so they are always re-encoded to cut them frame-accurately
+                    stream_copy=False,
                 )
-                pbar.update()
+            )
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
@@ -0,0 +1,47 @@
+from moviepy.editor import VideoFileClip
+from action_clips import (
+    DELTA as DELTA_ACTION,
+    get_audio_array,
+    get_volume_buffer,
+    window_rms,
+)
+from transition_clips import DELTA as DELTA_TRANS, get_frame_diffs
+
+
+def analyze(raw_filepath):
+    """
+    Makes a single pass through the video of the given filepath and returns
+    `(volumes, frame_diffs, rotated)`: the inputs to action and transition detection
+    respectively, and whether the video is rotated (which decides how clips are saved)
+
+    Frames are decoded once at one every DELTA_TRANS seconds; alongside each frame,
+    the volumes of the audio windows (of length DELTA_ACTION) that fall in that stretch are computed
+    """
+    with VideoFileClip(raw_filepath) as clip:
+        rotated = clip.rotation == 90
+        if rotated:
+            clip = clip.resize(clip.size[::-1])
+            clip.rotation = 0
+        print("Analyzing video - this may take a while...")
+        audio = get_audio_array(clip, raw_filepath)
+        window, volumes = get_volume_buffer(audio)
+        windows_per_frame = int(round(DELTA_TRANS / DELTA_ACTION))
+
+        def frames_with_volumes():
+            start = 0
+            for frame in clip.iter_frames(
+                fps=1 / DELTA_TRANS, dtype="uint8", logger=None
+            ):
+                stop = min(start + windows_per_frame, len(volumes))
+                window_rms(
+                    audio[start * window : stop * window], window, volumes[start:stop]
+                )
+                start = stop
+                yield frame
+            # audio can run slightly past the last decoded frame
+            window_rms(audio[start * window :], window, volumes[start:])
+
+        frame_diffs = get_frame_diffs(
+            frames_with_volumes(), total=int(clip.duration / DELTA_TRANS)
+        )
+    return volumes, frame_diffs, rotated
@@ -1,4 +1,5 @@
 import sys
+from analysis import analyze
 from action_clips import generate_action_clips
 from transition_clips import generate_transition_clips
 
@@ -7,5 +8,6 @@ if __name__ == "__main__":
         raise Exception(
             "Specify the raw video's filename (e.g. `python3 script.py raw_vid.MOV`)"
         )
-    generate_action_clips(sys.argv[1])
-    generate_transition_clips(sys.argv[1])
+    volumes, frame_diffs, rotated = analyze(sys.argv[1])
+    generate_action_clips(sys.argv[1], volumes, rotated)
+    generate_transition_clips(sys.argv[1], frame_diffs, rotated)
@@ -1,65 +1,125 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from tqdm import tqdm
 from moviepy.editor import VideoFileClip
+from utils import save_video_clip_from_file, smooth
+
+try:
+    import cupy as cp  # optional: frame comparisons run on the GPU when available
+
+    if not cp.cuda.is_available():
+        cp = None
+except ImportError:
+    cp = None
 
 TRIGGER_PERCENTILE = 10
 CLIP_DIRECTORY = "transition_clips"
 MIN_DURATION = 2.0
 DELTA = 0.5  # length of subclips to compare over (in seconds)
+DIFF_THRESHOLD = 8  # grayscale levels a pixel must change by to count as different
+FRAME_BATCH = 256  # frames to hold in memory at once when comparing
+SMOOTHING_WINDOW = 3  # samples to average over before finding events (1.5 seconds)
 
 
-def grayscale_and_downsample(arr, downsample_factor=4):
-    arr = arr[0::downsample_factor, 0::downsample_factor]
-    return np.dot(
-        arr, [0.2989, 0.5870, 0.1140]
-    )  # magic numbers for converting RGB to grayscale
+def shrink_by_two(arr):
+    """
+    Halves both dimensions of the frame by averaging each 2x2 block of pixels
+    (an odd trailing row or column is dropped)
+    """
+    h, w = arr.shape[0] // 2 * 2, arr.shape[1] // 2 * 2
+    arr = arr[:h, :w].astype(np.uint16)
+    total = arr[0::2, 0::2] + arr[1::2, 0::2] + arr[0::2, 1::2] + arr[1::2, 1::2]
+    return (total >> 2).astype(np.uint8)
 
 
-def compare_frames(clip, t1, t2):
-    frame1 = grayscale_and_downsample(clip.get_frame(t1))
-    frame2 = grayscale_and_downsample(clip.get_frame(t2))
-    diff = frame2 - frame1
-    l_0 = np.linalg.norm(diff.ravel(), ord=0)
-    return l_0 / diff.size
+def grayscale_and_downsample(arr, downsample_factor=4):
+    if downsample_factor < 1 or downsample_factor & (downsample_factor - 1):
+        raise ValueError(
+            f"downsample_factor must be a power of two (got {downsample_factor})"
+        )
+    while downsample_factor > 1:
+        arr = shrink_by_two(arr)
+        downsample_factor //= 2
+    arr = arr.astype(np.uint16)
+    # fixed-point (x256) versions of the 0.2989, 0.5870, 0.1140 RGB to grayscale weights
+    gray = (arr[..., 0] * 77 + arr[..., 1] * 150 + arr[..., 2] * 29) >> 8
+    return gray.astype(np.uint8)
+
+
+def compare_frame_batch(frames):
+    """
+    Takes a stack of N consecutive grayscaled and downsampled uint8 frames (N x H x W)
+    and returns the N - 1 fractions of pixels that changed by more than DIFF_THRESHOLD
+    between each frame and the next, computed in one vectorized pass
+    Runs on the GPU when CuPy is available
+    """
+    if cp is not None:
+        frames = cp.asarray(frames)  # one upload per batch instead of per frame
+    xp = np if cp is None else cp.get_array_module(frames)
+    diff = xp.abs(xp.diff(frames.astype(xp.int16), axis=0))
+    return (diff > DIFF_THRESHOLD).mean(axis=(1, 2)).tolist()
 
 
-def get_frame_by_frame_diffs(clip):
+def get_frame_diffs(frames, total=None):
+    """
+    Compares each uint8 RGB frame yielded by `frames` with the one before it
+    and returns the list of comparisons (`total` is the expected count, for the progress bar)
+
+    Frames are collected into batches of FRAME_BATCH so memory stays bounded on long videos;
+    the last frame of each batch is carried over so no pair of frames is skipped
+    """
     comparisons = []
-    time_range = np.arange(0, clip.duration - DELTA, DELTA)
-    with tqdm(total=len(time_range)) as pbar:
-        for t1 in time_range:
-            t2 = t1 + DELTA
-            diff = compare_frames(clip, t1, t2)
-            comparisons.append(diff)
-            pbar.update()
+    batch = None
+    n_frames = 0
+    with tqdm(total=total) as pbar:
+        for frame in frames:
+            frame = grayscale_and_downsample(frame)
+            if batch is None:
+                batch = np.empty((FRAME_BATCH,) + frame.shape, dtype=np.uint8)
+            batch[n_frames] = frame
+            n_frames += 1
+            if n_frames == FRAME_BATCH:
+                comparisons += compare_frame_batch(batch)
+                pbar.update(n_frames - 1)
+                batch[0] = batch[-1]
+                n_frames = 1
+        if n_frames > 1:
+            comparisons += compare_frame_batch(batch[:n_frames])
+            pbar.update(n_frames - 1)
     return comparisons
 
 
-def get_transition_peak(frame_diffs):
-    threshold = np.percentile(frame_diffs, TRIGGER_PERCENTILE)
-    top_indices = [idx for idx, diff in enumerate(frame_diffs) if diff <= threshold]
-    return top_indices
+def get_frame_by_frame_diffs(clip):
+    """
+    Decodes the clip sequentially at one frame every DELTA seconds
+    and compares each frame with the one before it
+    """
+    return get_frame_diffs(
+        clip.iter_frames(fps=1 / DELTA, dtype="uint8", logger=None),
+        total=int(clip.duration / DELTA),
+    )
 
 
 def get_transition_intervals(frame_diffs):
-    top_indices = get_transition_peak(frame_diffs)
-    median = np.percentile(frame_diffs, 50)
-    transition_slices = []
-    for top_idx in top_indices:
-        # check if already in a slice
-        for start_idx, end_idx in transition_slices:
-            if top_idx >= start_idx and top_idx <= end_idx:
-                break
-        else:
-            # populate new slice
-            left_idx = top_idx - 1
-            while frame_diffs[left_idx] < median:
-                left_idx -= 1
-            right_idx = top_idx + 1
-            while frame_diffs[right_idx] < median:
-                right_idx += 1
-            transition_slices.append((left_idx, right_idx))
+    frame_diffs = smooth(np.asarray(frame_diffs), SMOOTHING_WINDOW)
+    # sort once and read both percentiles off by (nearest) index
+    sorted_arr = np.sort(frame_diffs)
+    n = len(sorted_arr)
+    median = sorted_arr[n // 2]
+    threshold = sorted_arr[int(n * TRIGGER_PERCENTILE / 100)]
+    top_indices = np.nonzero(frame_diffs <= threshold)[0]
+    # label every continuous run where the signal stays at or below the median (still
+    # footage often scores exactly 0, which can also be the median): the run id
+    # goes up by one at each sample outside a run, so those samples bound the runs
+    below = frame_diffs <= median
+    run_id = np.cumsum(~below)
+    bounds = np.r_[0, np.flatnonzero(~below), len(frame_diffs) - 1]
+
+    # map each peak to the run that contains it, keeping every run once
+    top_indices = top_indices[below[top_indices]]
+    runs = np.unique(run_id[top_indices])
+    transition_slices = [(int(bounds[k]), int(bounds[k + 1])) for k in runs]
     return transition_slices
 
 
@@ -75,33 +135,39 @@ def get_transition_events(frame_diffs):
     ]
 
 
-def save_video_clip(video, save_filename, t_start, t_end):
+def generate_transition_clips(raw_filepath, frame_diffs=None, rotated=None):
     """
-    Takes start and end times (in seconds) for video and returns clipped
-    video and saves it locally
-    Times can be expressed in seconds (15.35), in (min, sec), in (hour, min, sec), or as a string: ‘01:03:05.35’
+    Identify and save transition clips from the video of the given filepath
+    `frame_diffs` and `rotated` can be passed in if they were already computed
+    (e.g. by `analysis.analyze`), in which case the video isn't opened for analysis
+    Rotated videos have to be re-encoded, everything else can be stream copied
     """
-    clip = video.subclip(t_start, t_end)
-    clip.write_videofile(save_filename, codec="libx264", audio_codec="aac", logger=None)
-
-
-def generate_transition_clips(raw_filepath):
-    with VideoFileClip(raw_filepath) as clip:
-        if clip.rotation == 90:
-            clip = clip.resize(clip.size[::-1])
-            clip.rotation = 0
-        print("Identifying transition events - this may take a while...")
-        frame_diffs = get_frame_by_frame_diffs(clip)
-        transitions = get_transition_events(frame_diffs)
-        print("Saving transition clips...")
-        os.makedirs(CLIP_DIRECTORY, exist_ok=True)
-        with tqdm(total=len(transitions)) as pbar:
-            for idx, (t_start, t_end) in enumerate(transitions):
-                clip_number = str(idx).zfill(
-                    len(str(len(transitions)))
-                )  # makes a zero-padded string of the clip index (e.g. '3' -> '003')
-                pbar.set_description(f"Saving clip #{clip_number}")
-                save_video_clip(
-                    clip, f"{CLIP_DIRECTORY}/trans_{clip_number}.MOV", t_start, t_end
+    if frame_diffs is None or rotated is None:
+        with VideoFileClip(raw_filepath) as clip:
+            rotated = clip.rotation == 90
+            if rotated:
+                clip = clip.resize(clip.size[::-1])
+                clip.rotation = 0
+            print("Identifying transition events - this may take a while...")
+            frame_diffs = get_frame_by_frame_diffs(clip)
+    transitions = get_transition_events(frame_diffs)
+    print("Saving transition clips...")
+    os.makedirs(CLIP_DIRECTORY, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for idx, (t_start, t_end) in enumerate(transitions):
+            clip_number = str(idx).zfill(
+                len(str(len(transitions)))
+            )  # makes a zero-padded string of the clip index (e.g. '3' -> '003')
+            futures.append(
+                executor.submit(
+                    save_video_clip_from_file,
+                    raw_filepath,
+                    f"{CLIP_DIRECTORY}/trans_{clip_number}.MOV",
+                    t_start,
+                    t_end,
+                    rotated,
                 )
-                pbar.update()
+            )
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
@@ -0,0 +1,79 @@
+import subprocess
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.editor import VideoFileClip
+
+
+def smooth(arr, width):
+    """
+    Returns the centered moving average of `arr` over `width` samples, so single-sample
+    dips and spikes don't split or create events. The output has the same length as `arr`
+    """
+    padded = np.pad(arr, (width // 2, width - 1 - width // 2), mode="edge")
+    csum = np.cumsum(np.r_[0, padded], dtype=np.float64)  # float32 sums lose precision
+    return (csum[width:] - csum[:-width]) / width
+
+
+def save_video_clip(video, save_filename, t_start, t_end, raw_filepath=None):
+    """
+    Takes start and end times (in seconds) for video and returns clipped
+    video and saves it locally
+    Times can be expressed in seconds (15.35), in (min, sec), in (hour, min, sec), or as a string: ‘01:03:05.35’
+
+    If `raw_filepath` is given, the clip is cut straight out of that file with an ffmpeg
+    stream copy instead of being decoded and re-encoded. A stream copy can only start on a
+    keyframe, so the saved clip may begin up to one keyframe interval before `t_start`
+    """
+    if raw_filepath is not None:
+        subprocess.run(
+            [
+                get_setting("FFMPEG_BINARY"),
+                "-y",
+                "-loglevel",
+                "error",
+                "-ss",
+                str(t_start),
+                "-to",
+                str(t_end),
+                "-i",
+                raw_filepath,
+                "-c",
+                "copy",
+                "-avoid_negative_ts",
+                "make_zero",
+                save_filename,
+            ],
+            check=True,
+        )
+        return
+    clip = video.subclip(t_start, t_end)
+    clip.write_videofile(
+        save_filename,
+        codec="libx264",
+        audio_codec="aac",
+        preset="ultrafast",
+        threads=1,  # clips are already encoded in parallel, one per process
+        ffmpeg_params=["-tune", "fastdecode", "-crf", "23"],
+        logger=None,
+    )
+
+
+def save_video_clip_from_file(
+    raw_filepath, save_filename, t_start, t_end, rotated, stream_copy=True
+):
+    """
+    Saves a single clip of the video at `raw_filepath`, meant to be run in its own process
+
+    If `stream_copy` is set and the video isn't rotated, the clip is stream copied; since that
+    starts on the keyframe before `t_start`, it only suits clips much longer than a keyframe
+    interval. Otherwise the video is opened with its own VideoFileClip and the clip is
+    re-encoded, which cuts it frame-accurately
+    """
+    if stream_copy and not rotated:
+        save_video_clip(None, save_filename, t_start, t_end, raw_filepath=raw_filepath)
+        return
+    with VideoFileClip(raw_filepath) as video:
+        if rotated:
+            video = video.resize(video.size[::-1])
+            video.rotation = 0
+        save_video_clip(video, save_filename, t_start, t_end)